@@ -1,40 +1,271 @@
 import os
+import re
+import atexit
 import shutil
+import tempfile
+import hashlib
+import bisect
+import weakref
 import traceback
+import threading
 import multiprocessing
+from multiprocessing import shared_memory
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 from tqdm import tqdm
 from scipy.ndimage import map_coordinates
 from amr_kitchen.utils import TastesBadError, shape_from_header
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bound on the length of the FAB header line
+# at the start of each box in the binary files
+FAB_HEADER_SCAN = 256
+
+def binary_file_cache_size(max_size=512):
+    """
+    Number of binary files kept open between box reads, at most
+    half of the open file limit of the process (256 by default
+    on macOS) so the other files can still be opened
+    """
+    if resource is None:
+        return max_size
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if limit == resource.RLIM_INFINITY:
+        return max_size
+    return max(min(max_size, limit // 2), 1)
+
+BINARY_FILE_CACHE_SIZE = binary_file_cache_size()
+
+class BinaryFile(object):
+    """
+    Plotfile binary file kept open between box reads. Positioned
+    reads do not move the file offset so a file can be shared
+    between threads (os.pread is not available on Windows where
+    the file is memory mapped instead)
+    ___
+    path: path of the binary file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = -1
+        # Set once the header of the first box read was compared
+        # to the shape given by the level header
+        self.checked = False
+        if hasattr(os, 'preadv'):
+            self.fd = os.open(path, os.O_RDONLY)
+            # The readers hold a reference during their reads so the
+            # file is only closed once it left the cache and is unused
+            # (finalize also closes the files still open at exit)
+            weakref.finalize(self, os.close, self.fd)
+        else:
+            self.mmap = np.memmap(path, dtype='uint8', mode='r')
+
+    def read(self, offset, nbytes):
+        """
+        Read nbytes at offset in the binary file
+        """
+        if self.fd < 0:
+            return self.mmap[offset:offset + nbytes].tobytes()
+        return os.pread(self.fd, nbytes, offset)
+
+    def read_floats(self, offset, count):
+        """
+        Read count float64 values at offset in the binary file
+        """
+        if self.fd < 0:
+            return np.frombuffer(self.mmap, 'float64', count, offset).copy()
+        data = np.empty(count, dtype='float64')
+        nbytes = os.preadv(self.fd, [data], offset)
+        if nbytes != data.nbytes:
+            raise ValueError((f"Expected {data.nbytes} bytes at offset"
+                              f" {offset} in {self.path} but only {nbytes}"
+                              f" could be read"))
+        return data
+
+# Open binary files by (path, inode, mtime, size) so a plotfile
+# replaced at the same path is not read from the stale files
+binary_files = OrderedDict()
+binary_file_keys = {}
+binary_files_lock = threading.Lock()
+
+def binary_file(bfile):
+    """
+    Open BinaryFile of a plotfile binary file, the files are
+    kept in a least recently used cache so they are only
+    opened once. The file at the path is checked to be the
+    cached one, which costs a stat call
+    ___
+    bfile: path of the binary file
+    """
+    stat = os.stat(bfile)
+    key = (bfile, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with binary_files_lock:
+        handle = binary_files.get(key)
+        if handle is not None:
+            binary_files.move_to_end(key)
+            return handle
+    handle = BinaryFile(bfile)
+    with binary_files_lock:
+        handle = binary_files.setdefault(key, handle)
+        binary_files.move_to_end(key)
+        # Drop the file previously found at this path
+        stale = binary_file_keys.get(bfile)
+        if stale is not None and stale != key:
+            binary_files.pop(stale, None)
+        binary_file_keys[bfile] = key
+        while len(binary_files) > BINARY_FILE_CACHE_SIZE:
+            old_key, _ = binary_files.popitem(last=False)
+            if binary_file_keys.get(old_key[0]) == old_key:
+                del binary_file_keys[old_key[0]]
+    return handle
+
+def reset_binary_files_lock():
+    """
+    Give a forked child process a new binary file cache lock as
+    the lock can be held by a thread of the parent during the fork
+    """
+    global binary_files_lock
+    binary_files_lock = threading.Lock()
+
+def open_binary_file(bfile):
+    """
+    BinaryFile last opened at the path of a binary file, used
+    by the box readers so the file identity is only checked by
+    binary_file once per read and not for every box
+    ___
+    bfile: path of the binary file
+    """
+    with binary_files_lock:
+        key = binary_file_keys.get(bfile)
+        handle = binary_files.get(key)
+        if handle is not None:
+            binary_files.move_to_end(key)
+            return handle
+    return binary_file(bfile)
+
+def box_data_start(bf, offset, shape, strict):
+    """
+    Find the offset of the data of the box starting at offset
+    in a binary file. The box shape is known from the level
+    header so the FAB header is only parsed in strict mode,
+    to validate the first box read in each binary file
+    ___
+    bf: BinaryFile of the binary file
+    """
+    header = bf.read(offset, FAB_HEADER_SCAN)
+    header_size = header.index(b'\n') + 1
+    if strict and not bf.checked:
+        header_shape = shape_from_header(header[:header_size].decode('ascii'))
+        if not np.array_equal(header_shape, shape):
+            raise ValueError((f"The box at offset {offset} in {bf.path} has"
+                              f" shape {header_shape.tolist()} but the level"
+                              f" header gives {np.asarray(shape).tolist()}"))
+        bf.checked = True
+    return offset + header_size
 
 def mp_read_box_single_field(args):
-    with open(args[0], 'rb') as bf:
-        bf.seek(args[1])
-        shape = shape_from_header(bf.readline().decode('ascii'))
-        bf.seek(np.prod(shape[:-1]) * args[2] * 8, 1)
-        data = np.fromfile(bf, 'float64', np.prod(shape[:-1]))
+    shape = args[3]
+    bf = open_binary_file(args[0])
+    data_start = box_data_start(bf, args[1], shape, args[4])
+    field_size = np.prod(shape[:-1])
+    data = bf.read_floats(data_start + field_size * args[2] * 8,
+                          field_size)
     return data.reshape(shape[:-1], order='F')
 
 def mp_read_box_slice_field(args):
-    with open(args[0], 'rb') as bf:
-        bf.seek(args[1])
-        shape = shape_from_header(bf.readline().decode('ascii'))
-        start, stop = args[2].indices(shape[-1])[:2]
-        slice_size = stop - start
-        bf.seek(np.prod(shape[:-1]) * start * 8, 1)
-        data = np.fromfile(bf, 'float64', np.prod(shape[:-1]) * slice_size)
+    shape = args[3]
+    bf = open_binary_file(args[0])
+    data_start = box_data_start(bf, args[1], shape, args[4])
+    start, stop, step = args[2].indices(shape[-1])
+    slice_size = stop - start
+    field_size = np.prod(shape[:-1])
+    data = bf.read_floats(data_start + field_size * start * 8,
+                          field_size * slice_size)
     data = data.reshape(np.append(shape[:-1], slice_size), order='F')
-    return data[..., args[2]]
+    # The data starts at the first field of the slice
+    return data[..., ::step]
 
 def mp_read_box_index_field(args):
-    diff = args[2][-1] - args[2][0] + 1
-    with open(args[0], 'rb') as bf:
-        bf.seek(args[1])
-        shape = shape_from_header(bf.readline().decode('ascii'))
-        bf.seek(np.prod(shape[:-1]) * args[2][0] * 8, 1)
-        data = np.fromfile(bf, 'float64', np.prod(shape[:-1])*diff)
+    # The indices are not necessarily sorted
+    low, high = args[2].min(), args[2].max()
+    diff = high - low + 1
+    shape = args[3]
+    bf = open_binary_file(args[0])
+    data_start = box_data_start(bf, args[1], shape, args[4])
+    field_size = np.prod(shape[:-1])
+    # When less than half the fields between the lowest and
+    # highest indices are requested only read the requested fields
+    if len(args[2]) / diff < 0.5:
+        data = np.empty(np.append(shape[:-1], len(args[2])), order='F')
+        for i, field in enumerate(args[2]):
+            field_data = bf.read_floats(data_start + field_size * field * 8,
+                                        field_size)
+            data[..., i] = field_data.reshape(shape[:-1], order='F')
+        return data
+    data = bf.read_floats(data_start + field_size * low * 8,
+                          field_size * diff)
     data = data.reshape(np.append(shape[:-1], diff), order='F')
-    return data[..., np.array(args[2]) - args[2][0]]
+    return data[..., np.array(args[2]) - low]
+
+def mp_read_box_single_field_3d(args):
+    """
+    mp_read_box_single_field for 3D boxes with the shape given
+    as a tuple of ints so the sizes are computed without numpy
+    """
+    bfile, offset, field, shape, strict = args
+    bf = open_binary_file(bfile)
+    data_start = box_data_start(bf, offset, shape, strict)
+    field_size = shape[0] * shape[1] * shape[2]
+    data = bf.read_floats(data_start + field_size * field * 8,
+                          field_size)
+    return data.reshape(shape[:3], order='F')
+
+def mp_read_box_slice_field_3d(args):
+    """
+    mp_read_box_slice_field for 3D boxes with the shape given
+    as a tuple of ints
+    """
+    bfile, offset, field_slice, shape, strict = args
+    bf = open_binary_file(bfile)
+    data_start = box_data_start(bf, offset, shape, strict)
+    start, stop, step = field_slice.indices(shape[3])
+    slice_size = stop - start
+    field_size = shape[0] * shape[1] * shape[2]
+    data = bf.read_floats(data_start + field_size * start * 8,
+                          field_size * slice_size)
+    data = data.reshape((shape[0], shape[1], shape[2], slice_size), order='F')
+    return data[..., ::step]
+
+def mp_read_box_index_field_3d(args):
+    """
+    mp_read_box_index_field for 3D boxes with the shape given
+    as a tuple of ints and the field indices as a list of ints
+    """
+    bfile, offset, fields, shape, strict = args
+    low, high = min(fields), max(fields)
+    diff = high - low + 1
+    bf = open_binary_file(bfile)
+    data_start = box_data_start(bf, offset, shape, strict)
+    field_size = shape[0] * shape[1] * shape[2]
+    if len(fields) / diff < 0.5:
+        data = np.empty((shape[0], shape[1], shape[2], len(fields)), order='F')
+        for i, field in enumerate(fields):
+            field_data = bf.read_floats(data_start + field_size * field * 8,
+                                        field_size)
+            data[..., i] = field_data.reshape(shape[:3], order='F')
+        return data
+    data = bf.read_floats(data_start + field_size * low * 8,
+                          field_size * diff)
+    data = data.reshape((shape[0], shape[1], shape[2], diff), order='F')
+    return data[..., [field - low for field in fields]]
 
 def mp_read_bfile_single_field(args):
     file_data = []
@@ -56,41 +287,268 @@ def mp_read_bfile_slice_field(args):
         while True:
             try:
                 shape = shape_from_header(bf.readline().decode('ascii'))
-                start, stop = args[1].indices(shape[-1])[:2]
+                start, stop, step = args[1].indices(shape[-1])
                 slice_size = stop - start
                 bf.seek(np.prod(shape[:-1]) * start * 8, 1)
                 data = np.fromfile(bf, 'float64', np.prod(shape[:-1]) * slice_size)
                 bf.seek(np.prod(shape[:-1]) * (shape[-1] - slice_size - start) * 8, 1)
                 data = data.reshape(np.append(shape[:-1], slice_size), order='F')
-                file_data.append(data[..., args[1]])
+                # The data starts at the first field of the slice
+                file_data.append(data[..., ::step])
             except Exception as e:
                 print(type(e), e)
                 break
     return file_data
 
 def mp_read_bfile_index_field(args):
-    diff = args[1][-1] - args[1][0] + 1
+    low, high = np.min(args[1]), np.max(args[1])
+    diff = high - low + 1
     file_data = []
     with open(args[0], 'rb') as bf:
         while True:
             try:
                 shape = shape_from_header(bf.readline().decode('ascii'))
-                bf.seek(np.prod(shape[:-1]) * args[1][0] * 8, 1)
+                bf.seek(np.prod(shape[:-1]) * low * 8, 1)
                 data = np.fromfile(bf, 'float64', np.prod(shape[:-1]) * diff)
-                bf.seek(np.prod(shape[:-1]) * (shape[-1] - args[1][-1] - 1) * 8, 1)
+                bf.seek(np.prod(shape[:-1]) * (shape[-1] - high - 1) * 8, 1)
                 data = data.reshape(np.append(shape[:-1], diff), order='F')
-                file_data.append(data[..., np.array(args[1]) - args[1][0]])
+                file_data.append(data[..., np.array(args[1]) - low])
             except:
                 break
     return file_data
 
+def ghost_map_kernel(box_array, barr_indices):
+    """
+    Find the boxes adjacent to the faces of every box of
+    a level from its 3D box array
+    returns the flat array of the sorted adjacent box indices
+    for each (box, dimension, face) and the offsets of each
+    (box, dimension, face) in the flat array
+    (compiled with numba when it is available)
+    """
+    n_boxes = barr_indices.shape[0]
+    shape = box_array.shape
+    # Bounds of the box array slab scanned for each face
+    slabs = np.empty((n_boxes * 6, 2, 3), dtype=np.int64)
+    max_size = 0
+    for b in range(n_boxes):
+        for coo in range(3):
+            for face in range(2):
+                slab = slabs[b * 6 + coo * 2 + face]
+                slab_size = 1
+                for d in range(3):
+                    lo = barr_indices[b, 0, d]
+                    hi = barr_indices[b, 1, d]
+                    if face == 0 and d == coo:
+                        lo = max(lo - 1, 0)
+                    elif face == 1:
+                        hi += 1
+                        if d == coo:
+                            hi = min(hi + 1, shape[d] - 1)
+                    hi = max(min(hi, shape[d]), lo)
+                    slab[0, d] = lo
+                    slab[1, d] = hi
+                    slab_size *= hi - lo
+                max_size += slab_size
+    # Scratch array to find each box index once per face
+    # (shifted by one as uncovered cells have index -1)
+    seen = np.zeros(n_boxes + 1, dtype=np.uint8)
+    box_ids = np.empty(max_size, dtype=np.int64)
+    offsets = np.zeros(n_boxes * 6 + 1, dtype=np.int64)
+    pos = 0
+    for f in range(n_boxes * 6):
+        start = pos
+        b = f // 6
+        for i in range(slabs[f, 0, 0], slabs[f, 1, 0]):
+            for j in range(slabs[f, 0, 1], slabs[f, 1, 1]):
+                for k in range(slabs[f, 0, 2], slabs[f, 1, 2]):
+                    bid = box_array[i, j, k]
+                    if bid != b and seen[bid + 1] == 0:
+                        seen[bid + 1] = 1
+                        box_ids[pos] = bid
+                        pos += 1
+        box_ids[start:pos].sort()
+        for n in range(start, pos):
+            seen[box_ids[n] + 1] = 0
+        offsets[f + 1] = pos
+    return box_ids[:pos], offsets
+
+if njit is not None:
+    ghost_map_kernel = njit(cache=True)(ghost_map_kernel)
+
+def pool_chunksize(ntasks):
+    """
+    Number of tasks sent at once to each pool worker
+    so the IPC cost is amortized over a few boxes
+    """
+    return max(1, ntasks // (4 * os.cpu_count()))
+
+def mp_read_many_boxes(args):
+    """
+    Read multiple boxes in the same binary file
+    args: (box reading function, binary file, offsets,
+           field argument, box shapes, strict)
+    """
+    read_fun, bfile, offsets, field_arg, shapes, strict = args
+    # Check that the open file is the one at the path once per task
+    binary_file(bfile)
+    return [read_fun((bfile, offset, field_arg, shape, strict))
+            for offset, shape in zip(offsets, shapes)]
+
+def mp_read_many_boxes_into(args):
+    """
+    Read multiple boxes in the same binary file directly
+    into a preallocated output array
+    args: (box reading function, binary file, offsets,
+           field argument, box shapes, strict, output,
+           positions of the boxes in the output)
+    """
+    output, positions = args[6:]
+    for i, box_data in zip(positions, mp_read_many_boxes(args[:6])):
+        output[i] = box_data
+
+def mp_read_many_boxes_shared(args):
+    """
+    Read multiple boxes in the same binary file into
+    a shared memory arena
+    args: (box reading function, binary file, offsets,
+           field argument, box shapes, strict, arena name,
+           (byte offset, data shape) of each box in the arena)
+    """
+    name, locations = args[6:]
+    # The arena is attached for each task so the workers do not
+    # keep its memory mapped once the arena is unlinked
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        for (start, shape), box_data in zip(locations, mp_read_many_boxes(args[:6])):
+            np.ndarray(shape, dtype='float64', buffer=shm.buf,
+                       offset=start)[...] = box_data
+    finally:
+        shm.close()
+
+class SharedMemoryArena(object):
+
+    # Alignment of the allocated blocks in bytes
+    alignment = 64
+
+    def __init__(self, size):
+        """
+        Shared memory block from which the box data read by
+        the process pool workers is allocated. The arrays
+        returned are views of the block and their memory is
+        given back to the arena when they are garbage collected
+        ___
+        size: size of the arena in bytes
+        """
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+        self.size = size
+        # Sorted list of the free [offset, size] blocks
+        self.free = [[0, size]]
+        # Blocks released by the garbage collector, which can
+        # run while the free list is modified, so they are only
+        # merged in the free list when the lock is acquired
+        self.released = deque()
+        self.lock = threading.Lock()
+        # Number of allocated blocks not merged back in the free list
+        self.nblocks = 0
+        self.closed = False
+
+    def allocate(self, nbytes):
+        """
+        Return the offset of a free block of nbytes or None if
+        the arena does not have one or was closed
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            self.merge_released()
+            nbytes = -(-nbytes // self.alignment) * self.alignment
+            for block in self.free:
+                if block[1] >= nbytes:
+                    start = block[0]
+                    block[0] += nbytes
+                    block[1] -= nbytes
+                    if block[1] == 0:
+                        self.free.remove(block)
+                    self.nblocks += 1
+                    return start
+            # Do not keep an unused arena too small for the request
+            if self.nblocks == 0:
+                self.close()
+            return None
+
+    def merge_released(self):
+        """
+        Merge the released blocks in the free list
+        (called with the lock acquired)
+        """
+        while self.released:
+            self.merge(*self.released.popleft())
+            self.nblocks -= 1
+
+    def merge(self, start, nbytes):
+        """
+        Add a block to the free list and merge it with
+        its free neighbours
+        """
+        i = bisect.bisect(self.free, [start, nbytes])
+        self.free.insert(i, [start, nbytes])
+        if i + 1 < len(self.free) and start + nbytes == self.free[i + 1][0]:
+            self.free[i][1] += self.free.pop(i + 1)[1]
+        if i > 0 and self.free[i - 1][0] + self.free[i - 1][1] == start:
+            self.free[i - 1][1] += self.free.pop(i)[1]
+
+    def release(self, start, nbytes):
+        """
+        Give a block back to the arena
+        """
+        nbytes = -(-nbytes // self.alignment) * self.alignment
+        self.released.append((start, nbytes))
+        # The lock is held if the block is released by the garbage
+        # collector during an allocation, which merges the block
+        if self.lock.acquire(blocking=False):
+            try:
+                self.merge_released()
+                # Give the memory back once no block is in use
+                if self.nblocks == 0:
+                    self.close()
+            finally:
+                self.lock.release()
+
+    def array(self, start, shape):
+        """
+        float64 array of the given shape viewing the block at
+        start, which is released when the array and all the
+        views derived from it are garbage collected
+        """
+        data = np.ndarray(shape, dtype='float64', buffer=self.shm.buf, offset=start)
+        weakref.finalize(data, self.release, start, data.nbytes)
+        return data
+
+    def close(self):
+        """
+        Remove the shared memory block, arrays still
+        viewing it remain valid until they are collected
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.shm.close()
+        except BufferError:
+            # Arrays using the arena are still alive
+            pass
+        self.shm.unlink()
+
 class LevelDataIterator(object):
 
-    def __init__(self, fun, bfiles, field_arg):
-        pool = multiprocessing.Pool()
-        self.iterator = pool.imap(fun,
-                                  zip(bfiles,
-                                      [field_arg]*len(bfiles)))
+    def __init__(self, file_data):
+        """
+        Iterate over the boxes data given an iterator
+        yielding the list of boxes data of each binary file
+        """
+        self.iterator = file_data
         self._data = self.iterator.__next__().__iter__()
 
     def __iter__(self):
@@ -105,90 +563,364 @@ class LevelDataIterator(object):
 
 class LevelDataStream(object):
 
-    def __init__(self, bfiles, offsets, field_arg):
-        self.bfiles = np.array(bfiles)
-        self.offsets = np.array(offsets)
+    # Process pool and thread pool shared by every data stream
+    _pool = None
+    _executor = None
+    # Shared memory arenas receiving the process pool results
+    _arenas = []
+    # Minimum size of a new arena in bytes
+    arena_size = 2**28
+
+    def __init__(self, bfiles, offsets, field_arg, shapes,
+                 use_processes=False, strict=True):
+        """
+        Access the AMR boxes data of a level
+        ___
+        bfiles: binary file of each box
+        offsets: offset of each box in its binary file
+        field_arg: field index, slice or list of indices
+        shapes: (n_boxes, ndims + 1) array of the box data shapes
+                including the number of fields in the binary files
+        use_processes: read the boxes with a process pool instead
+                       of threads (reading is IO bound so threads
+                       are usually faster as no data is pickled)
+        strict: check the binary header of the first box read in
+                each binary file against its expected shape
+        """
+        self.bfiles = np.asarray(bfiles)
+        self.offsets = np.asarray(offsets)
+        self.shapes = np.asarray(shapes)
         self.size = len(bfiles)
         self.farg = field_arg
+        self.use_processes = use_processes
+        self.strict = strict
+        # Binary files checked to be the open ones by this stream
+        self.checked_bfiles = set()
+        # 3D boxes are read with functions specialized for
+        # tuple shapes to avoid numpy calls for every box
+        self.is_3d = self.shapes.ndim == 2 and self.shapes.shape[1] == 4
+        # Field argument given to the box reading functions
+        self.box_farg = self.farg
         if isinstance(self.farg, int):
-            self.read_fun = mp_read_box_single_field
+            if self.is_3d:
+                self.read_fun = mp_read_box_single_field_3d
+            else:
+                self.read_fun = mp_read_box_single_field
             self.file_fun = mp_read_bfile_single_field
         elif isinstance(self.farg, slice):
-            self.read_fun = mp_read_box_slice_field
+            if self.is_3d:
+                self.read_fun = mp_read_box_slice_field_3d
+            else:
+                self.read_fun = mp_read_box_slice_field
             self.file_fun = mp_read_bfile_slice_field
         elif (isinstance(self.farg, list) or
               isinstance(self.farg, np.ndarray)):
             self.farg = np.array(self.farg)
             assert self.farg.ndim == 1, "Field slice indices must be one dimensional"
-            self.read_fun = mp_read_box_index_field
+            if self.is_3d:
+                self.read_fun = mp_read_box_index_field_3d
+                self.box_farg = self.farg.tolist()
+            else:
+                self.read_fun = mp_read_box_index_field
+                self.box_farg = self.farg
             self.file_fun = mp_read_bfile_index_field
 
+    @classmethod
+    def get_pool(cls):
+        """
+        Return the process pool used to read the box data
+        The pool is created on the first call and reused
+        afterwards so the workers are only started once
+        """
+        if cls._pool is None:
+            cls._pool = multiprocessing.Pool()
+            atexit.register(cls.close_pool)
+        return cls._pool
+
+    @classmethod
+    def get_executor(cls):
+        """
+        Return the thread pool used to read the box data
+        The box reads are IO bound and release the GIL
+        """
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=os.cpu_count() * 2)
+            atexit.register(cls.close_pool)
+        return cls._executor
+
+    @classmethod
+    def close_pool(cls):
+        """
+        Terminate the shared process and thread pools
+        """
+        if cls._pool is not None:
+            cls._pool.terminate()
+            cls._pool.join()
+            cls._pool = None
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=False)
+            cls._executor = None
+        for arena in cls._arenas:
+            arena.close()
+        cls._arenas = []
+
+    @classmethod
+    def allocate_shared(cls, nbytes):
+        """
+        Allocate nbytes in a shared memory arena, creating a
+        new arena if none of the existing ones has enough room
+        Returns the arena and the offset of the block
+        """
+        # Forget the arenas closed when their blocks were released
+        cls._arenas = [arena for arena in cls._arenas if not arena.closed]
+        for arena in cls._arenas:
+            start = arena.allocate(nbytes)
+            if start is not None:
+                return arena, start
+        arena = SharedMemoryArena(max(nbytes, cls.arena_size))
+        cls._arenas.append(arena)
+        return arena, arena.allocate(nbytes)
+
+    @classmethod
+    def reset_pools(cls):
+        """
+        Forget the pools and arenas inherited by a forked child
+        process, the pool threads and workers of the parent do not
+        exist in the child so new ones are created on the next read
+        """
+        cls._pool = None
+        cls._executor = None
+        cls._arenas = []
+
+    def map(self, fun, tasks):
+        """
+        Apply fun to the tasks in parallel and return the
+        results in order as a list
+        """
+        if self.use_processes:
+            return self.get_pool().map(fun, tasks,
+                                       chunksize=pool_chunksize(len(tasks)))
+        return list(self.get_executor().map(fun, tasks))
+
+    def imap(self, fun, tasks):
+        """
+        Apply fun to the tasks in parallel and return an
+        iterator over the results in order
+        """
+        if self.use_processes:
+            return self.get_pool().imap(fun, tasks,
+                                        chunksize=pool_chunksize(len(tasks)))
+        return self.get_executor().map(fun, tasks)
+
+    def imap_unordered(self, fun, tasks):
+        """
+        Apply fun to the tasks in parallel and return an
+        iterator over the results as they are completed
+        """
+        if self.use_processes:
+            return self.get_pool().imap_unordered(fun, tasks,
+                                                  chunksize=pool_chunksize(len(tasks)))
+        futures = [self.get_executor().submit(fun, task) for task in tasks]
+        return (future.result() for future in as_completed(futures))
+
     def __getitem__(self, idx):
         if isinstance(idx, int):
+            self.check_bfiles([self.bfiles[idx]])
             return self.read_fun((self.bfiles[idx],
                                   self.offsets[idx],
-                                  self.farg))
+                                  self.box_farg,
+                                  self.box_shapes(idx),
+                                  self.strict))
         elif isinstance(idx, slice):
-            slice_size = len(range(*idx.indices(self.size)))
-            pool = multiprocessing.Pool()
-            return pool.map(self.read_fun,
-                            zip(self.bfiles[idx],
-                                self.offsets[idx],
-                                [self.farg]*slice_size))
+            return self.read_boxes(idx)
         elif (isinstance(idx, list) or
               isinstance(idx, np.ndarray)):
             if len(idx) == 0:
                 return []
             idx = np.array(idx)
             assert idx.ndim == 1, "Box slice indices must be one dimensional"
-            pool = multiprocessing.Pool()
-            if idx.dtype == int:
-                count = len(idx)
-            elif idx.dtype == bool:
-                count = np.count_nonzero(idx)
-            return pool.map(self.read_fun,
-                            zip(self.bfiles[idx],
-                                self.offsets[idx],
-                                [self.farg]*count))
+            return self.read_boxes(idx)
+
+    def check_bfiles(self, bfiles):
+        """
+        Check once per stream that the open binary files are
+        the ones at their paths before reading single boxes
+        (the pool tasks of read_boxes check their own file)
+        """
+        for bfile in bfiles:
+            if bfile not in self.checked_bfiles:
+                binary_file(bfile)
+                self.checked_bfiles.add(bfile)
+
+    def box_shapes(self, idx):
+        """
+        Shapes given to the box reading functions for the boxes
+        selected by idx, the 3D shapes are converted to tuples
+        only for the selected boxes
+        """
+        shapes = self.shapes[idx]
+        if not self.is_3d:
+            return shapes
+        if shapes.ndim == 1:
+            return tuple(shapes.tolist())
+        return [tuple(shape) for shape in shapes.tolist()]
+
+    def data_shape(self, shape):
+        """
+        Shape of the data read for a box
+        ___
+        shape: (ndims + 1) shape of the box in the binary file
+        """
+        data_shape = list(shape[:-1])
+        if isinstance(self.farg, slice):
+            data_shape.append(len(range(*self.farg.indices(shape[-1]))))
+        elif not isinstance(self.farg, int):
+            data_shape.append(len(self.farg))
+        return tuple(data_shape)
+
+    def output_shape(self, shapes):
+        """
+        Shape of the data read for the boxes if they all have
+        the same shape, None otherwise
+        ___
+        shapes: (n_boxes, ndims + 1) array of the box shapes
+        """
+        if len(shapes) == 0 or np.any(shapes != shapes[0]):
+            return None
+        return (len(shapes),) + self.data_shape(shapes[0].tolist())
+
+    def read_boxes(self, idx):
+        """
+        Read the boxes selected by idx using one pool task per
+        binary file so each file is only opened once
+        The box data is returned in the input order, as a single
+        array when the boxes have the same shape and as a list
+        of arrays otherwise
+        """
+        bfiles = self.bfiles[idx]
+        offsets = self.offsets[idx]
+        shapes = self.box_shapes(idx)
+        if len(bfiles) == 0:
+            return []
+        # Box positions in the output for each binary file
+        groups = defaultdict(list)
+        for i, bf in enumerate(bfiles):
+            groups[bf].append(i)
+        # Read the boxes of a file in the order they are stored
+        for positions in groups.values():
+            positions.sort(key=lambda i: offsets[i])
+        tasks = [(self.read_fun, bf, offsets[positions], self.box_farg,
+                  [shapes[i] for i in positions], self.strict)
+                 for bf, positions in groups.items()]
+        out_shape = self.output_shape(self.shapes[idx])
+        if self.use_processes:
+            return self.read_boxes_shared(tasks, list(groups.values()),
+                                          self.shapes[idx], out_shape)
+        # Ragged boxes are returned as a list
+        if out_shape is None:
+            file_data = self.map(mp_read_many_boxes, tasks)
+            data = [None] * len(bfiles)
+            for positions, boxes_data in zip(groups.values(), file_data):
+                for i, box_data in zip(positions, boxes_data):
+                    data[i] = box_data
+            return data
+        # Threads write the boxes directly in the output
+        data = np.empty(out_shape)
+        self.map(mp_read_many_boxes_into,
+                 [task + (data, positions)
+                  for task, positions in zip(tasks, groups.values())])
+        return data
+
+    def read_boxes_shared(self, tasks, groups, shapes, out_shape):
+        """
+        Read the boxes with the process pool into a block of a
+        shared memory arena so the data is not sent back to
+        the parent process through the pool pipes
+        ___
+        tasks: mp_read_many_boxes arguments of each binary file
+        groups: positions in the output of the boxes of each task
+        shapes: (n_boxes, ndims + 1) array of the box shapes
+        out_shape: shape of the output for uniform boxes or None
+        """
+        data_shapes = [self.data_shape(shape) for shape in shapes.tolist()]
+        sizes = [int(np.prod(shape)) for shape in data_shapes]
+        # Start of each box in the block in float64 values
+        starts = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+        arena, block = self.allocate_shared(starts[-1] * 8)
+        try:
+            self.map(mp_read_many_boxes_shared,
+                     [task + (arena.name,
+                              [(block + starts[i] * 8, data_shapes[i])
+                               for i in positions])
+                      for task, positions in zip(tasks, groups)])
+        except Exception:
+            arena.release(block, starts[-1] * 8)
+            raise
+        if out_shape is not None:
+            return arena.array(block, out_shape)
+        # Ragged boxes are views of the same block
+        data = arena.array(block, (starts[-1],))
+        return [data[start:start + size].reshape(shape)
+                for start, size, shape in zip(starts, sizes, data_shapes)]
+
     def __iter__(self):
-        return LevelDataIterator(self.file_fun,
-                                 np.unique(self.bfiles),
-                                 self.farg)
+        bfiles = np.unique(self.bfiles)
+        return LevelDataIterator(self.imap_unordered(self.file_fun,
+                                                     list(zip(bfiles,
+                                                              [self.farg]*len(bfiles)))))
     def iter(self, idx):
         """
         Manual data iterator to support reading data
         on the fly for slices
         """
         if isinstance(idx, int):
+            self.check_bfiles([self.bfiles[idx]])
             return self.read_fun((self.bfiles[idx],
                                   self.offsets[idx],
-                                  self.farg))
+                                  self.box_farg,
+                                  self.box_shapes(idx),
+                                  self.strict))
         elif isinstance(idx, slice):
             slice_size = len(range(*idx.indices(self.size)))
-            pool = multiprocessing.Pool()
-            return pool.imap(self.read_fun,
-                            zip(self.bfiles[idx],
-                                self.offsets[idx],
-                                [self.farg]*slice_size))
+            self.check_bfiles(np.unique(self.bfiles[idx]))
+            return self.imap(self.read_fun,
+                             list(zip(self.bfiles[idx],
+                                      self.offsets[idx],
+                                      [self.box_farg]*slice_size,
+                                      self.box_shapes(idx),
+                                      [self.strict]*slice_size)))
         elif (isinstance(idx, list) or
               isinstance(idx, np.ndarray)):
             if len(idx) == 0:
                 return []
             idx = np.array(idx)
             assert idx.ndim == 1, "Box slice indices must be one dimensional"
-            pool = multiprocessing.Pool()
             if idx.dtype == int:
                 count = len(idx)
             elif idx.dtype == bool:
                 count = np.count_nonzero(idx)
-            return pool.imap(self.read_fun,
-                            zip(self.bfiles[idx],
-                                self.offsets[idx],
-                                [self.farg]*count))
+            self.check_bfiles(np.unique(self.bfiles[idx]))
+            return self.imap(self.read_fun,
+                             list(zip(self.bfiles[idx],
+                                      self.offsets[idx],
+                                      [self.box_farg]*count,
+                                      self.box_shapes(idx),
+                                      [self.strict]*count)))
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_binary_files_lock)
+    os.register_at_fork(after_in_child=LevelDataStream.reset_pools)
 
 class LevelDataSelector(object):
 
-    def __init__(self, fields, cells, field_arg, limit_level, boxes = None, dx = None):
+    def __init__(self, fields, cells, field_arg, limit_level, boxes = None, dx = None,
+                 use_processes = False):
+        """
+        Select the AMR level of the field data
+        ___
+        use_processes: read the boxes of the level data streams with
+                       the process pool instead of threads
+        """
         # Convert key to field index
         if isinstance(field_arg, str):
             field_arg = fields[field_arg]
@@ -197,26 +929,59 @@ class LevelDataSelector(object):
                isinstance(field_arg, np.ndarray)) and
                isinstance(field_arg[0], str)):
             field_arg = [fields[fname] for fname in field_arg]
-        try:
-            _ = np.array(list(fields.keys()))[field_arg]
-            self.farg = field_arg
-        except IndexError:
+        if not self.valid_field_arg(field_arg, len(fields)):
             raise IndexError((f"The field indexing [{field_arg}] is not"
                               f" compatible with the number of fields"
                               f" in the plotfile ({len(fields)})"))
+        self.farg = field_arg
         self.cells = cells
         self.fields = fields
         self.limit_level = limit_level
         self.boxes = boxes
         self.dx = dx
+        self.use_processes = use_processes
+
+    @staticmethod
+    def valid_field_arg(field_arg, nfields):
+        """
+        Check that the field indexing can be used on an
+        array with nfields values (same as numpy indexing)
+        """
+        if isinstance(field_arg, slice):
+            return True
+        if isinstance(field_arg, (int, np.integer)):
+            return -nfields <= field_arg < nfields
+        if isinstance(field_arg, (list, np.ndarray)):
+            field_arg = np.asarray(field_arg)
+            if field_arg.ndim != 1:
+                return False
+            if field_arg.dtype == bool:
+                return len(field_arg) == nfields
+            if len(field_arg) == 0:
+                return True
+            return (np.issubdtype(field_arg.dtype, np.integer) and
+                    field_arg.min() >= -nfields and
+                    field_arg.max() < nfields)
+        return False
 
     def __getitem__(self, key):
         if key > self.limit_level:
             raise ValueError((f"The maximum AMR level of the plotfile"
                               f" is {self.limit_level}"))
-        return LevelDataStream(self.cells[key]['files'],
-                               self.cells[key]['offsets'],
-                               self.farg)
+        level = self.cells[key]
+        # Box data shapes with the number of fields, computed
+        # once per level and kept with the level cells
+        if 'shapes' not in level:
+            indexes = level['indexes']
+            shapes = np.empty((len(indexes), indexes.shape[-1] + 1), dtype=int)
+            shapes[:, :-1] = indexes[:, 1] - indexes[:, 0] + 1
+            shapes[:, -1] = len(self.fields)
+            level['shapes'] = shapes
+        return LevelDataStream(level['files'],
+                               level['offsets'],
+                               self.farg,
+                               level['shapes'],
+                               use_processes=self.use_processes)
     def __call__(self, x, y, z):
         pass
 
@@ -371,8 +1136,60 @@ class LevelDataSelector(object):
                 return point_data
         
 
+def save_npz_cache(cache_path, cache):
+    """
+    Save parsed header data to a npz cache file
+    Nothing is written if the plotfile is read only
+    """
+    # Write to a unique temporary file so a concurrent read never
+    # sees a partially written cache, even with several writers
+    # in different threads, processes or nodes
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp",
+                                        dir=os.path.dirname(cache_path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as cfile:
+            np.savez(cfile, **cache)
+        # mkstemp only gives access to the owner
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class HeaderData(dict):
+    """
+    Parsed base header data of a plotfile shared by the
+    PlotfileCooker instances through the parse cache
+    ___
+    nlevels: number of levels of which the boxes were read
+    """
+    nlevels = 0
+
+    def covers(self, limit_level):
+        """
+        True if the boxes are read up to limit_level
+        (up to the maximum level if limit_level is None)
+        """
+        if limit_level is None:
+            limit_level = self['max_level']
+        return limit_level < self.nlevels
+
 class PlotfileCooker(object):
 
+    # Parsed base header data of the plotfiles in use, keyed by the
+    # Header path, inode and stamp. The entries are held weakly so
+    # the data is dropped with the last instance using it
+    _parse_cache = weakref.WeakValueDictionary()
+    # Attributes set by parsing the base header
+    header_attributes = ('version', 'nvars', 'fields', 'ndims', 'time',
+                         'max_level', 'geo_low', 'geo_high', 'factors',
+                         'grid_sizes', 'step_numbers', 'dx', 'sys_coord',
+                         'step', 'npoints', 'cell_paths', 'box_centers',
+                         'boxes')
+
     def __init__(self,
                  plotfile_path: str,
                  limit_level: int = None,
@@ -397,71 +1214,19 @@ class PlotfileCooker(object):
         """
         self.pfile = plotfile_path
         filepath = os.path.join(self.pfile, 'Header')
-        with open(filepath) as hfile:
-            self.version = hfile.readline()
-            # field names
-            self.nvars = int(hfile.readline())
-            self.fields = {}
-            for i in range(self.nvars):
-                field_name = hfile.readline().replace('\n', '')
-                if field_name not in self.fields:
-                    self.fields[field_name] = i
-                else:
-                    repeat_number = 2
-                    while True:
-                        field_name_extra =  f"{field_name}_{repeat_number}" 
-                        if field_name_extra not in self.fields:
-                            self.fields[field_name_extra] = i
-                            break
-                        else:
-                            repeat_number += 1
-
-            # General data
-            self.ndims = int(hfile.readline())
-            self.time = float(hfile.readline())
-            self.max_level = int(hfile.readline())
-            self.geo_low = [float(n) for n in hfile.readline().split()]
-            self.geo_high = [float(n) for n in hfile.readline().split()]
-            self.factors = [int(n) for n in hfile.readline().split()]
-            self.grid_sizes = []
-            for block in hfile.readline().split()[1::3]:
-                grid_size = np.array(block.replace('(', '').replace(")", '').split(','), dtype=int)
-                self.grid_sizes.append(grid_size + 1)
-            self.step_numbers = [int(n) for n in hfile.readline().split()]
-            # Grid resolutions
-            resolutions = []
-            for i in range(self.max_level + 1):
-                resolutions.append([float(n) for n in hfile.readline().split()])
-            self.dx = resolutions
-            # Coordinate system
-            self.sys_coord = hfile.readline()
-            # Sanity check
-            assert 0 == int(hfile.readline())
-            # Define the max level we read
-            if limit_level is None:
-                self.limit_level = self.max_level
-            elif limit_level <= self.max_level:
-                self.limit_level=limit_level
-            else:
-                raise ValueError((f"The limit level must be less or equal than"
-                                  f" the maximum AMR level of the plotfile:"
-                                  f" {limit_level} > {self.max_level}"))
-            # Read the box geometry
-            try:
-                self.box_centers, self.boxes = self.read_boxes(hfile)
-            except Exception as e:
-                # If the class is created from a Taster class
-                if validate_mode:
-                    # Get the actual exception string
-                    catched_tback = traceback.format_exc()
-                    raise TastesBadError((f"PlotfileCooker encountered a fatal"
-                                          f" exception while reading the boxes"
-                                           " coordinates in the method self.read_boxes."
-                                           " This could be due to missing or badly"
-                                           " formated box data. The exception message is:"
-                                          f" {catched_tback}"))
-                else:
-                    raise e
+        # The caches are not used when validating the plotfile
+        cache_key = None
+        if not validate_mode:
+            # The inode tells apart plotfiles copied to the same path
+            cache_key = ((os.path.abspath(filepath), os.stat(filepath).st_ino)
+                         + tuple(self.header_stamp(filepath).tolist()))
+        header_data = None
+        if cache_key is not None:
+            header_data = self._parse_cache.get(cache_key)
+        if header_data is not None and header_data.covers(limit_level):
+            self.use_header_data(header_data, limit_level)
+        else:
+            self.read_header(filepath, limit_level, validate_mode, cache_key)
 
         # Compute the global 1D grids
         self.grids = self.compute_global_grids()
@@ -482,6 +1247,10 @@ class PlotfileCooker(object):
                                           f" \n {catched_tback}"))
                 else:
                     raise e
+            # Boxes indices in each binary file
+            self._bfile_groups = self.compute_binfile_groups()
+            # Hash of the box indices of each level
+            self._mesh_fingerprint = self.compute_mesh_fingerprint()
         # Gets the number fields in the plt_file
         self.nfields = len(self.fields)
         # Compute the ghost boxes map around each box
@@ -512,6 +1281,11 @@ class PlotfileCooker(object):
         # Fail if the maximum AMR level is different
         if self.limit_level != other.limit_level:
             return False
+        # Fail if the box indices hashes are different
+        if (hasattr(self, '_mesh_fingerprint') and
+            hasattr(other, '_mesh_fingerprint') and
+            self._mesh_fingerprint != other._mesh_fingerprint):
+            return False
         # Compare boxes
         for lv in range(self.limit_level + 1):
             if not np.allclose(self.boxes[lv], other.boxes[lv]):
@@ -561,9 +1335,19 @@ class PlotfileCooker(object):
 
         The third layer defines from which AMR box the data is selected.
         integer, slice and array like indices are supported. If the index
-        argument is not an integer, multiprocessing is used to read the data.
-        Because the shape of the data is not consistent between boxes, a list
-        of arrays is returned for non integer slices.
+        argument is not an integer, a thread pool is used to read the data.
+        For non integer slices a single array with the boxes along the first
+        axis is returned when the selected boxes have the same shape, and a
+        list of arrays is returned otherwise.
+        The boxes can be read with a process pool into shared memory instead
+        by setting `use_processes` on the level selector (threads are usually
+        faster as reading is IO bound):
+
+        ```
+        selector = PlotfileCooker["temp"]
+        selector.use_processes = True
+        T_lv = selector[lv][:]
+        ```
         The box data shape has the format `(shape_x, shape_y, shape_z, fields)`.
 
         ```
@@ -617,6 +1401,193 @@ class PlotfileCooker(object):
     Method for constructing the class from plotfile mesh data
     """
 
+    def read_header(self, filepath, limit_level, validate_mode, cache_key):
+        """
+        Read the base header file, the boxes up to the limit level
+        are read and the data is stored in the parse cache if
+        cache_key is not None
+        """
+        # The header cache also holds the boxes of the levels read
+        if validate_mode or not self.load_header_cache(filepath, limit_level):
+            with open(filepath) as hfile:
+                self.parse_header(hfile)
+                # Check the max level we read
+                self.set_limit_level(limit_level)
+                # Read the box geometry
+                try:
+                    self.box_centers, self.boxes = self.read_boxes(hfile)
+                except Exception as e:
+                    # If the class is created from a Taster class
+                    if validate_mode:
+                        # Get the actual exception string
+                        catched_tback = traceback.format_exc()
+                        raise TastesBadError((f"PlotfileCooker encountered a fatal"
+                                              f" exception while reading the boxes"
+                                               " coordinates in the method self.read_boxes."
+                                               " This could be due to missing or badly"
+                                               " formated box data. The exception message is:"
+                                              f" {catched_tback}"))
+                    else:
+                        raise e
+            if not validate_mode:
+                self.save_header_cache(filepath)
+        if cache_key is not None:
+            header_data = HeaderData((name, getattr(self, name))
+                                     for name in self.header_attributes)
+            header_data.nlevels = len(self.boxes)
+            PlotfileCooker._parse_cache[cache_key] = header_data
+            self.use_header_data(header_data, limit_level)
+        else:
+            self.set_limit_level(limit_level)
+
+    def use_header_data(self, header_data, limit_level):
+        """
+        Set the header attributes from the HeaderData of the parse
+        cache, the instance keeps a reference so the data stays in
+        the cache while the instance exists
+        """
+        self._header_data = header_data
+        # Copy the containers so the instances are independent
+        for name, value in header_data.items():
+            setattr(self, name, value.copy() if isinstance(value, (list, dict))
+                               else value)
+        self.set_limit_level(limit_level)
+
+    def set_limit_level(self, limit_level):
+        """
+        Define the max level we read and only keep
+        the boxes data up to that level
+        """
+        if limit_level is None:
+            self.limit_level = self.max_level
+        elif limit_level <= self.max_level:
+            self.limit_level=limit_level
+        else:
+            raise ValueError((f"The limit level must be less or equal than"
+                              f" the maximum AMR level of the plotfile:"
+                              f" {limit_level} > {self.max_level}"))
+        if hasattr(self, 'boxes'):
+            self.boxes = self.boxes[:self.limit_level + 1]
+            self.box_centers = self.box_centers[:self.limit_level + 1]
+            self.npoints = self.npoints[:self.limit_level + 1]
+            self.cell_paths = self.cell_paths[:self.limit_level + 1]
+
+    def parse_header(self, hfile):
+        """
+        Parse the general data at the start of the
+        base header file (everything before the boxes)
+        """
+        self.version = hfile.readline()
+        # field names
+        self.nvars = int(hfile.readline())
+        self.fields = {}
+        for i in range(self.nvars):
+            field_name = hfile.readline().replace('\n', '')
+            if field_name not in self.fields:
+                self.fields[field_name] = i
+            else:
+                repeat_number = 2
+                while True:
+                    field_name_extra =  f"{field_name}_{repeat_number}" 
+                    if field_name_extra not in self.fields:
+                        self.fields[field_name_extra] = i
+                        break
+                    else:
+                        repeat_number += 1
+
+        # General data
+        self.ndims = int(hfile.readline())
+        self.time = float(hfile.readline())
+        self.max_level = int(hfile.readline())
+        self.geo_low = [float(n) for n in hfile.readline().split()]
+        self.geo_high = [float(n) for n in hfile.readline().split()]
+        self.factors = [int(n) for n in hfile.readline().split()]
+        self.grid_sizes = []
+        for block in hfile.readline().split()[1::3]:
+            grid_size = np.array(block.replace('(', '').replace(")", '').split(','), dtype=int)
+            self.grid_sizes.append(grid_size + 1)
+        self.step_numbers = [int(n) for n in hfile.readline().split()]
+        # Grid resolutions
+        resolutions = []
+        for i in range(self.max_level + 1):
+            resolutions.append([float(n) for n in hfile.readline().split()])
+        self.dx = resolutions
+        # Coordinate system
+        self.sys_coord = hfile.readline()
+        # Sanity check
+        assert 0 == int(hfile.readline())
+
+    def load_header_cache(self, hfile_path, limit_level):
+        """
+        Load the base header data and the boxes of the levels read
+        from the .pck_header_cache.npz file in the plotfile directory,
+        returns False if the cache is missing, stale or does not have
+        the boxes up to limit_level
+        """
+        cache_path = os.path.join(self.pfile, ".pck_header_cache.npz")
+        if not os.path.isfile(cache_path):
+            return False
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                if not np.array_equal(cache["stamp"],
+                                      self.header_stamp(hfile_path)):
+                    return False
+                if limit_level is None:
+                    limit_level = int(cache["max_level"])
+                if len(cache["npoints"]) <= limit_level:
+                    return False
+                self.version = str(cache["version"])
+                self.nvars = int(cache["nvars"])
+                self.fields = {str(name): i for i, name
+                               in enumerate(cache["field_names"])}
+                self.ndims = int(cache["ndims"])
+                self.time = float(cache["time"])
+                self.max_level = int(cache["max_level"])
+                self.geo_low = cache["geo_low"].tolist()
+                self.geo_high = cache["geo_high"].tolist()
+                self.factors = cache["factors"].tolist()
+                self.grid_sizes = list(cache["grid_sizes"])
+                self.step_numbers = cache["step_numbers"].tolist()
+                self.dx = cache["dx"].tolist()
+                self.sys_coord = str(cache["sys_coord"])
+                self.step = str(cache["step"])
+                self.cell_paths = cache["cell_paths"].tolist()
+                self.npoints = cache["npoints"].tolist()
+                # The boxes of the levels read are saved as a single array
+                boxes = cache["boxes"]
+        except Exception:
+            # A damaged cache file is parsed again and replaced
+            return False
+        self.boxes = np.split(boxes, np.cumsum(self.npoints)[:-1])
+        self.box_centers = [lv_boxes[..., 0] + (lv_boxes[..., 1] - lv_boxes[..., 0])/2
+                            for lv_boxes in self.boxes]
+        return True
+
+    def save_header_cache(self, hfile_path):
+        """
+        Save the base header data and the boxes of the levels
+        read to .pck_header_cache.npz in the plotfile directory
+        """
+        cache = {"stamp": self.header_stamp(hfile_path),
+                 "version": self.version,
+                 "nvars": self.nvars,
+                 "field_names": np.array(list(self.fields), dtype=str),
+                 "ndims": self.ndims,
+                 "time": self.time,
+                 "max_level": self.max_level,
+                 "geo_low": np.array(self.geo_low, dtype=float),
+                 "geo_high": np.array(self.geo_high, dtype=float),
+                 "factors": np.array(self.factors, dtype=int),
+                 "grid_sizes": np.array(self.grid_sizes, dtype=int),
+                 "step_numbers": np.array(self.step_numbers, dtype=int),
+                 "dx": np.array(self.dx, dtype=float),
+                 "sys_coord": self.sys_coord,
+                 "step": self.step,
+                 "cell_paths": np.array(self.cell_paths, dtype=str),
+                 "npoints": np.array(self.npoints, dtype=int),
+                 "boxes": np.concatenate(self.boxes)}
+        save_npz_cache(os.path.join(self.pfile, ".pck_header_cache.npz"), cache)
+
     def read_boxes(self, hfile):
         """
         Read the AMR boxes geometry in the base header file
@@ -641,17 +1612,14 @@ class PlotfileCooker(object):
             assert current_level == lv
             # Key for the dict
             self.npoints.append(n_cells)
-            lv_points = []
-            lv_boxes = []
-            for i in range(n_cells):
-                point = []
-                box = []
-                for i in range(self.ndims):
-                    lo, hi = [float(n) for n in hfile.readline().split()]
-                    box.append([lo, hi])
-                    point.append(lo + (hi - lo)/2)
-                lv_points.append(point)
-                lv_boxes.append(box)
+            # Read the (lo, hi) bounds of every box at once
+            if n_cells > 0:
+                lv_boxes = np.loadtxt(hfile,
+                                      max_rows=n_cells * self.ndims,
+                                      ndmin=2).reshape(n_cells, self.ndims, 2)
+            else:
+                lv_boxes = np.empty((0, self.ndims, 2))
+            lv_points = lv_boxes[..., 0] + (lv_boxes[..., 1] - lv_boxes[..., 0])/2
             cell_dir = hfile.readline().split('/')[0]
             self.cell_paths.append(cell_dir)
             points.append(lv_points)
@@ -661,85 +1629,157 @@ class PlotfileCooker(object):
     def read_cell_headers(self, maxmins, validate_mode):
         """
         Read the cell header data and the maxs/mins for a given level
+        The parsed data is cached in a Cell_H.npz file next to the
+        level header to skip the text parsing on the next read
         """
         cells = []
-        all_maxs = []
-        all_mins = []
         for i in range(self.limit_level + 1):
             lvcells = {}
-            all_maxs.append({})
-            all_mins.append({})
             cfile_path = os.path.join(self.pfile, self.cell_paths[i], "Cell_H")
-            with open(cfile_path) as cfile:
-                # Skip 2 lines
-                cfile.readline()
-                cfile.readline()
-                # Are we good
-                n_fields_valid = cfile.readline()
-                assert int(n_fields_valid) == len(self.fields)
-                cfile.readline()
-                n_cells = int(cfile.readline().split()[0].replace('(', ''))
-                indexes = []
-                for _ in range(n_cells):
-                    start, stop, _ = cfile.readline().split()
-                    start = np.array(start.replace('(', '').replace(')', '').split(','), dtype=int)
-                    stop = np.array(stop.replace('(', '').replace(')', '').split(','), dtype=int)
-                    indexes.append([start, stop])
-                lvcells["indexes"] = indexes
-                cfile.readline()
-                assert n_cells == int(cfile.readline())
-                files = []
-                offsets = []
-                for _ in range(n_cells):
-                    _, file, offset = cfile.readline().split()
-                    files.append(os.path.join(self.pfile, self.cell_paths[i], file))
-                    offsets.append(int(offset))
-                if maxmins:
-                    lvmaxs = []
-                    lvmins = []
-                    cfile.readline()
-                    cfile.readline()
-                    for _ in range(n_cells):
-                        mins_str = cfile.readline().split(',')
-                        lvmins.append(np.array(mins_str[:-1], dtype=float))
-                    cfile.readline()
-                    cfile.readline()
-                    for _ in range(n_cells):
-                        maxs_str = cfile.readline().split(',')
-                        lvmaxs.append(np.array(maxs_str[:-1], dtype=float))
-            lvcells["files"] = files
+            # The cache is not used when validating the plotfile
+            cached = None
+            if not validate_mode:
+                cached = self.load_cell_header_cache(cfile_path, maxmins)
+            if cached is not None:
+                files, offsets, indexes, lvmins, lvmaxs = cached
+            else:
+                files, offsets, indexes, lvmins, lvmaxs = self.parse_cell_header(cfile_path,
+                                                                                 maxmins)
+                if not validate_mode:
+                    self.save_cell_header_cache(cfile_path, files, offsets,
+                                                indexes, lvmins, lvmaxs)
+            lvcells["indexes"] = indexes
+            # Only join the paths of the unique binary files
+            bfiles, bfile_ids = np.unique(files, return_inverse=True)
+            bfiles = np.array([os.path.join(self.pfile, self.cell_paths[i], file)
+                               for file in bfiles], dtype=str)
+            lvcells["files"] = bfiles[bfile_ids]
             lvcells["offsets"] = offsets
             if maxmins:
                 lvcells['mins'] = {}
                 lvcells['maxs'] = {}
-                for field, minvals, maxvals in zip(self.fields, 
-                                                   np.transpose(lvmins),
-                                                   np.transpose(lvmaxs)):
+                # One contiguous array of box values per field
+                lvmins = np.ascontiguousarray(np.transpose(lvmins))
+                lvmaxs = np.ascontiguousarray(np.transpose(lvmaxs))
+                for field, minvals, maxvals in zip(self.fields, lvmins, lvmaxs):
                     lvcells['mins'][field] = minvals
                     lvcells['maxs'][field] = maxvals
             cells.append(lvcells)
         return cells
 
+    def parse_cell_header(self, cfile_path, maxmins):
+        """
+        Parse a level header (Cell_H) file
+        returns the binary file names, the box offsets in the
+        binary files, the box indexes and the box mins/maxs
+        (None if maxmins is False)
+        """
+        lvmins, lvmaxs = None, None
+        with open(cfile_path) as cfile:
+            # Skip 2 lines
+            cfile.readline()
+            cfile.readline()
+            # Are we good
+            n_fields_valid = cfile.readline()
+            assert int(n_fields_valid) == len(self.fields)
+            cfile.readline()
+            n_cells = int(cfile.readline().split()[0].replace('(', ''))
+            # Box indexes lines look like ((0,0,0) (7,7,7) (0,0,0))
+            block = ''.join([cfile.readline() for _ in range(n_cells)])
+            indexes = np.fromstring(re.sub(r'[(),]', ' ', block),
+                                    sep=' ', dtype=np.int64)
+            indexes = np.ascontiguousarray(indexes.reshape(n_cells, 3, self.ndims)[:, :2])
+            cfile.readline()
+            assert n_cells == int(cfile.readline())
+            # Binary files lines look like FabOnDisk: Cell_D_00000 0
+            block = ''.join([cfile.readline() for _ in range(n_cells)]).split()
+            files = np.array(block[1::3], dtype=str)
+            offsets = np.array(block[2::3], dtype=np.int64)
+            if maxmins:
+                nfields = len(self.fields)
+                cfile.readline()
+                cfile.readline()
+                block = ''.join([cfile.readline() for _ in range(n_cells)])
+                lvmins = np.fromstring(block.replace(',', ' '), sep=' ')
+                lvmins = lvmins.reshape(n_cells, nfields)
+                cfile.readline()
+                cfile.readline()
+                block = ''.join([cfile.readline() for _ in range(n_cells)])
+                lvmaxs = np.fromstring(block.replace(',', ' '), sep=' ')
+                lvmaxs = lvmaxs.reshape(n_cells, nfields)
+        return files, offsets, indexes, lvmins, lvmaxs
+
+    @staticmethod
+    def header_stamp(header_path):
+        """
+        Modification time and size of a header file
+        used to know if its cached data is still valid
+        """
+        stat = os.stat(header_path)
+        return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+    def load_cell_header_cache(self, cfile_path, maxmins):
+        """
+        Load the parsed level header data from the Cell_H.npz
+        cache file, returns None if the cache is missing, stale
+        or does not contain the maxs/mins when they are needed
+        """
+        cache_path = cfile_path + ".npz"
+        if not os.path.isfile(cache_path):
+            return None
+        try:
+            with np.load(cache_path) as cache:
+                if not np.array_equal(cache["stamp"],
+                                      self.header_stamp(cfile_path)):
+                    return None
+                if maxmins and "mins" not in cache:
+                    return None
+                files = cache["files"]
+                offsets = cache["offsets"]
+                indexes = cache["indexes"]
+                lvmins, lvmaxs = None, None
+                if maxmins:
+                    lvmins = cache["mins"]
+                    lvmaxs = cache["maxs"]
+        except Exception:
+            # A damaged cache file is parsed again and replaced
+            return None
+        return files, offsets, indexes, lvmins, lvmaxs
+
+    def save_cell_header_cache(self, cfile_path, files, offsets,
+                               indexes, lvmins, lvmaxs):
+        """
+        Save the parsed level header data to Cell_H.npz
+        Nothing is written if the plotfile is read only
+        """
+        cache = {"stamp": self.header_stamp(cfile_path),
+                 "files": files,
+                 "offsets": offsets,
+                 "indexes": indexes}
+        if lvmins is not None:
+            cache["mins"] = lvmins
+            cache["maxs"] = lvmaxs
+        save_npz_cache(cfile_path + ".npz", cache)
+
     def field_index(self, field):
         """ return the index of a data field """
         # TODO: create a class to raise KeyError on __getitem__
-        for i, f in enumerate(self.fields):
-            if f == field:
-                return i
-        raise ValueError(f"""Field {field} was not found in file. 
-                             Available fields in {self.pfile.split('/')[-1]} are:
-                             {', '.join(self.fields.keys())} and grid_level""")
+        try:
+            return self.fields[field]
+        except KeyError:
+            raise ValueError(f"""Field {field} was not found in file. 
+                                 Available fields in {self.pfile.split('/')[-1]} are:
+                                 {', '.join(self.fields.keys())} and grid_level""")
 
     def unique_box_shapes(self):
         """
         Find the unique box shape tuples
         for each level
         """
-        shapes = []
-        for lv in range(self.limit_level + 1):
-            for idx in self.cells[lv]['indexes']:
-                shape = idx[1] - idx[0] + 1
-                shapes.append(tuple(shape))
+        shapes = np.concatenate([self.cells[lv]['indexes'][:, 1]
+                                 - self.cells[lv]['indexes'][:, 0] + 1
+                                 for lv in range(self.limit_level + 1)],
+                                axis=0)
         shapes = np.unique(shapes, axis=0)
         shapes = [tuple(shape) for shape in shapes]
         return shapes
@@ -784,18 +1824,54 @@ class PlotfileCooker(object):
     Iterators to loop over plotfile data manually
     """
 
+    def compute_binfile_groups(self):
+        """
+        Group the boxes of each level by binary file
+        returns a dict for each level mapping the binary
+        files (sorted) to the indices of their boxes
+        """
+        all_groups = []
+        for lv in range(self.limit_level + 1):
+            bfiles = self.cells[lv]['files']
+            order = np.argsort(bfiles, kind='stable')
+            unique_bfiles, starts, counts = np.unique(bfiles[order],
+                                                      return_index=True,
+                                                      return_counts=True)
+            all_groups.append({bf: order[start:start + count]
+                               for bf, start, count in zip(unique_bfiles,
+                                                           starts,
+                                                           counts)})
+        return all_groups
+
+    def compute_mesh_fingerprint(self):
+        """
+        Hash of the box indices at each level used to quickly
+        tell plotfiles with different meshes apart
+        """
+        fingerprint = []
+        for lv in range(self.limit_level + 1):
+            indexes = np.ascontiguousarray(self.cells[lv]['indexes'], dtype=np.int64)
+            digest = hashlib.blake2b(indexes.tobytes(), digest_size=8)
+            digest.update(str(indexes.shape).encode())
+            fingerprint.append(digest.digest())
+        return tuple(fingerprint)
+
+    def binfile_groups(self, lv):
+        """
+        Return the dict mapping the binary files at lv
+        to the indices of the boxes they contain
+        """
+        return self._bfile_groups[lv]
+
     def bybinfile(self, lv):
         """
         Iterate over header data at lv
         by individual binary files
         """
-        bfiles = np.array(self.cells[lv]['files'])
-        indexes = np.array(self.cells[lv]['indexes'])
-        offsets = np.array(self.cells[lv]['offsets'])
+        indexes = self.cells[lv]['indexes']
+        offsets = self.cells[lv]['offsets']
 
-        box_indexes = np.arange(len(bfiles))
-        for bf in np.unique(bfiles):
-            bf_indexes = box_indexes[bfiles == bf]
+        for bf, bf_indexes in self.binfile_groups(lv).items():
             yield (bf,
                    offsets[bf_indexes],
                    indexes[bf_indexes],)
@@ -805,25 +1881,41 @@ class PlotfileCooker(object):
         Iterate over header data at lv
         by individual binary files
         """
-        bfiles = np.array(self.cells[lv]['files'])
-        indexes = np.array(self.cells[lv]['indexes'])
-        offsets = np.array(self.cells[lv]['offsets'])
+        indexes = self.cells[lv]['indexes']
+        offsets = self.cells[lv]['offsets']
 
-        box_indexes = np.arange(len(bfiles))
-        for bf in np.unique(bfiles):
-            bf_indexes = box_indexes[bfiles == bf]
+        box_indexes = np.arange(len(offsets))
+        for bf, bf_indexes in self.binfile_groups(lv).items():
             yield (bf,
                    offsets[bf_indexes],
                    indexes[bf_indexes],
                    box_indexes)
 
+    def parallel_bybinfile(self, lv, worker, max_workers=None):
+        """
+        Apply a function to the header data of each binary
+        file at lv using a thread pool, reading the binary files
+        is IO bound so the files are processed concurrently
+        ___
+        lv: AMR level of the binary files
+        worker: function called as worker(bfname, offsets, indexes)
+                with the values yielded by self.bybinfile(lv)
+        max_workers: number of threads (ThreadPoolExecutor default
+                     if None)
+        returns the list of the worker outputs for each binary file
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(worker, bfname, offsets, indexes)
+                       for bfname, offsets, indexes in self.bybinfile(lv)]
+            return [future.result() for future in futures]
+
     def bybox(self, lv):
         """
         Iterate over header data for evey box
         """
-        bfiles = np.array(self.cells[lv]['files'])
-        indexes = np.array(self.cells[lv]['indexes'])
-        offsets = np.array(self.cells[lv]['offsets'])
+        bfiles = self.cells[lv]['files']
+        indexes = self.cells[lv]['indexes']
+        offsets = self.cells[lv]['offsets']
 
         for bf, idx, off in zip(bfiles, indexes, offsets):
             yield {"indexes":idx,
@@ -853,14 +1945,7 @@ class PlotfileCooker(object):
         Compute the index map of the AMR box offsets
         for each binary file
         """
-        bfiles = np.array(self.cells[lv]["files"])
-        offsets = np.array(self.cells[lv]["offsets"])
-        offsets_map = []
-        for bf in np.unique(bfiles):
-            mask = bf == bfiles
-            box_indices = np.flatnonzero(mask)
-            offsets_map.append(box_indices)
-        return offsets_map
+        return list(self.binfile_groups(lv).values())
 
     def by_binfile_output(self, other, lv, pltout, **kwargs):
         """
@@ -868,11 +1953,9 @@ class PlotfileCooker(object):
         instances with the assumption that the AMR boxes are
         in the same order in the binary data
         """
-        for bf1 in np.unique(self.cells[lv]['files']):
+        for bf1, box_indices in self.binfile_groups(lv).items():
             # The other binary file we read
-            mask = np.array(self.cells[lv]['files']) == bf1
-            other_idx = np.flatnonzero(mask)[0]
-            bf2 = other.cells[lv]['files'][other_idx]
+            bf2 = other.cells[lv]['files'][box_indices[0]]
             # Path to the combined binary files (for Windows)
             bfile_r1 = os.path.join(os.getcwd(), bf1)
             bfile_r2 = os.path.join(os.getcwd(), bf2)
@@ -895,18 +1978,15 @@ class PlotfileCooker(object):
         plotfile so that they correspond to the same global
         indices with an added output binary file
         """
-        # Map of which boxes are in which binary files
-        box_index_map = self.map_bfile_offsets(lv)
         # On process per binary file
-        for bf1, box_indices in zip(np.unique(self.cells[lv]['files']),
-                                    box_index_map):
+        for bf1, box_indices in self.binfile_groups(lv).items():
             # Other binary files
-            bfiles_2 = np.array(other.cells[lv]['files'])[box_indices]
+            bfiles_2 = other.cells[lv]['files'][box_indices]
             # Other offsets
-            offsets_2 = np.array(other.cells[lv]['offsets'])[box_indices]
+            offsets_2 = other.cells[lv]['offsets'][box_indices]
             # Offsets of the boxes in the binaries
-            offsets_bf1 = np.array(self.cells[lv]['offsets'])[box_indices]
-            offsets_bf2 = np.array(other.cells[lv]['offsets'])[box_indices]
+            offsets_bf1 = self.cells[lv]['offsets'][box_indices]
+            offsets_bf2 = other.cells[lv]['offsets'][box_indices]
             # Path to the combined binary files (for Windows)
             bfile_r1 = os.path.join(os.getcwd(), bf1)
             bfile_r2 = os.path.join(os.getcwd(), bfiles_2[0])
@@ -929,16 +2009,13 @@ class PlotfileCooker(object):
         the boxes in multiple files in the other plotfile to
         boxes in a single file in the current plotfile
         """
-        # Map of which boxes are in which binary files
-        box_index_map = self.map_bfile_offsets(lv)
         # On process per binary file
-        for bf1, box_indices in zip(np.unique(self.cells[lv]['files']),
-                                    box_index_map):
+        for bf1, box_indices in self.binfile_groups(lv).items():
             # The other binary file we read
             bf2 = other.cells[lv]['files'][box_indices[0]]
             # Offsets of the boxes in the binaries
-            offsets_bf1 = np.array(self.cells[lv]['offsets'])[box_indices]
-            offsets_bf2 = np.array(other.cells[lv]['offsets'])[box_indices]
+            offsets_bf1 = self.cells[lv]['offsets'][box_indices]
+            offsets_bf2 = other.cells[lv]['offsets'][box_indices]
             # Path to the combined binary files (for Windows)
             bfile_r1 = os.path.join(os.getcwd(), bf1)
             bfile_r2 = os.path.join(os.getcwd(), bf2)
@@ -976,16 +2053,27 @@ class PlotfileCooker(object):
         for lv in range(self.limit_level + 1):
             box_array_shape = self.grid_sizes[lv] // box_rez
             box_array = -1 * np.ones(box_array_shape, dtype=int)
-            lv_barray_indices = []
-            for i, idx in enumerate(self.cells[lv]["indexes"]):
-                bidx_lo = idx[0] // box_rez
-                bidx_hi = idx[1] // box_rez
-                box_array[bidx_lo[0]:bidx_hi[0] + 1,
-                          bidx_lo[1]:bidx_hi[1] + 1,
-                          bidx_lo[2]:bidx_hi[2] + 1] = i
-                lv_barray_indices.append([bidx_lo, bidx_hi])
+            indexes = self.cells[lv]["indexes"]
+            bidx_lo = indexes[:, 0] // box_rez
+            bidx_hi = indexes[:, 1] // box_rez
+            # Number of box array cells covered by each box
+            extents = bidx_hi - bidx_lo + 1
+            counts = np.prod(extents, axis=1)
+            # Box index of every covered cell
+            box_ids = np.repeat(np.arange(len(indexes)), counts)
+            # Flat position of every covered cell inside its box
+            flat = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts,
+                                                         counts)
+            # Unravel the flat positions with the shape of each box
+            cell_ids = np.empty((len(box_ids), self.ndims), dtype=int)
+            cell_extents = extents[box_ids]
+            for coo in reversed(range(self.ndims)):
+                cell_ids[:, coo] = flat % cell_extents[:, coo]
+                flat //= cell_extents[:, coo]
+            cell_ids += bidx_lo[box_ids]
+            box_array[tuple(cell_ids.T)] = box_ids
             box_arrays.append(box_array)
-            box_array_indices.append(lv_barray_indices)
+            box_array_indices.append(np.stack([bidx_lo, bidx_hi], axis=1))
         return box_arrays, box_array_indices
 
     def compute_ghost_map(self):
@@ -996,6 +2084,8 @@ class PlotfileCooker(object):
         is adjacent in a given direction the index is set
         to None
         """
+        if njit is not None:
+            return self.compute_ghost_map_compiled()
         ghost_map = []
         for lv in range(self.limit_level + 1):
             lv_gmap = []
@@ -1005,20 +2095,39 @@ class PlotfileCooker(object):
                 for coo in range(self.ndims):
                     idx_lo = np.copy(indices)
                     idx_lo[0][coo] = max(idx_lo[0][coo] - 1, 0)
-                    for bid in np.unique(self.box_arrays[lv][idx_lo[0][0]:idx_lo[1][0],
-                                                             idx_lo[0][1]:idx_lo[1][1],
-                                                             idx_lo[0][2]:idx_lo[1][2]]):
-                        if bid != box_index:
-                            gmap[coo][0].append(bid)
+                    slab = self.box_arrays[lv][idx_lo[0][0]:idx_lo[1][0],
+                                               idx_lo[0][1]:idx_lo[1][1],
+                                               idx_lo[0][2]:idx_lo[1][2]]
+                    gmap[coo][0].extend(sorted(set(slab.ravel().tolist()) - {box_index}))
 
                     idx_hi = np.copy(indices)
                     idx_hi[1] += 1
                     idx_hi[1][coo] = min(idx_hi[1][coo] + 1, barr_shape[coo] - 1)
-                    for bid in np.unique(self.box_arrays[lv][idx_hi[0][0]:idx_hi[1][0],
-                                                             idx_hi[0][1]:idx_hi[1][1],
-                                                             idx_hi[0][2]:idx_hi[1][2]]):
-                        if bid != box_index:
-                            gmap[coo][1].append(bid)
+                    slab = self.box_arrays[lv][idx_hi[0][0]:idx_hi[1][0],
+                                               idx_hi[0][1]:idx_hi[1][1],
+                                               idx_hi[0][2]:idx_hi[1][2]]
+                    gmap[coo][1].extend(sorted(set(slab.ravel().tolist()) - {box_index}))
+                lv_gmap.append(gmap)
+            ghost_map.append(lv_gmap)
+        return ghost_map
+
+    def compute_ghost_map_compiled(self):
+        """
+        Same as compute_ghost_map but the adjacency search is
+        done by the numba compiled ghost_map_kernel
+        """
+        ghost_map = []
+        for lv in range(self.limit_level + 1):
+            box_ids, offsets = ghost_map_kernel(self.box_arrays[lv],
+                                                self.barr_indices[lv].astype(np.int64))
+            box_ids = box_ids.tolist()
+            lv_gmap = []
+            for box_index in range(len(self.barr_indices[lv])):
+                gmap = []
+                for coo in range(3):
+                    f = box_index * 6 + coo * 2
+                    gmap.append([box_ids[offsets[f]:offsets[f + 1]],
+                                 box_ids[offsets[f + 1]:offsets[f + 2]]])
                 lv_gmap.append(gmap)
             ghost_map.append(lv_gmap)
         return ghost_map
@@ -1034,12 +2143,14 @@ class PlotfileCooker(object):
         """
         if limit_level is None:
             limit_level = self.limit_level
-        os.makedirs(os.path.join(os.getcwd(),outpath), exist_ok=True)
+        # Resolve the output path once for every level
+        base = os.path.abspath(outpath)
+        os.makedirs(base, exist_ok=True)
         #shutil.copy(os.path.join(self.pfile, 'Header'),
         #           outpath)
         for pth in self.cell_paths[:limit_level + 1]:
             level_dir = pth
-            os.makedirs(os.path.join(os.getcwd(),outpath, level_dir), exist_ok=True)
+            os.makedirs(os.path.join(base, level_dir), exist_ok=True)
             #shutil.copy(os.path.join(self.pfile, pth + '_H'),
             #            os.path.join(outpath, level_dir))
 
@@ -1056,154 +2167,114 @@ class PlotfileCooker(object):
                      header
         """
         hfile_path = os.path.join(plt_path, "Header")
-        nfields = len(field_names)
         # Check for duplicates
-        if len(field_names) != len(np.unique(field_names)):
+        if len(set(field_names)) != len(field_names):
             raise ValueError(("Cannot write plotfile header with duplicate"
                               " fields"))
         with open(hfile_path, 'w') as hfile:
-            # Plotfile version
-            hfile.write(self.version)
-            # Number of fields
-            hfile.write(f"{nfields}" + '\n')
-            # Fields
-            for f in field_names:
-                hfile.write(f + '\n')
-            # Number of dimensions
-            hfile.write(f"{self.ndims}\n")
-            # Time
-            hfile.write(str(self.time) + '\n')
-            # Max level
-            hfile.write(str(self.limit_level) + '\n')
-            # Lower bounds
-            hfile.write(' '.join([str(f) for f in self.geo_low]) + '\n')
-            # Upper bounds
-            hfile.write(' '.join([str(f) for f in self.geo_high]) + '\n')
-            # Refinement factors
-            factors = self.factors[:self.limit_level + 1]
-            hfile.write(' '.join([str(f) for f in factors]) + '\n')
-            # Grid sizes
-            # Looks like ((0,0,0) (7,7,7) (0,0,0))
-            tuples = []
-            for lv in range(self.limit_level + 1):
-                sizes = ",".join([str(s - 1) for s in self.grid_sizes[lv]])
-                if self.ndims == 3:
-                    tup = f"((0,0,0) ({sizes}) (0,0,0))"
-                elif self.ndims == 2:
-                    tup = f"((0,0) ({sizes}) (0,0))"
-                tuples.append(tup)
-            hfile.write(' '.join(tuples) + '\n')
-            # By level step numbers
-            step_numbers = self.step_numbers[:self.limit_level + 1]
-            hfile.write(' '.join([str(n) for n in step_numbers]) + '\n')
-            # Grid resolutions
-            for lv in range(self.limit_level + 1):
-                hfile.write(' '.join([str(dx) for dx in self.dx[lv]]) + '\n')
-            # Coordinate system
-            hfile.write(str(self.sys_coord))
-            # Zero for parsing
-            hfile.write("0\n")
-            # Write the boxes
-            for lv in range(self.limit_level + 1):
-                # Write the level info
-                hfile.write(f"{lv} {len(self.boxes[lv])} {self.time}\n")
-                # Write the level step
-                hfile.write(f"{self.step_numbers[lv]}\n")
-                # Write the boxes
-                for box in self.boxes[lv]:
-                    for d in range(self.ndims):
-                        hfile.write(f"{box[d][0]} {box[d][1]}\n")
-                # Write the Level path info
-                hfile.write(f"Level_{lv}/Cell\n")
+            hfile.write(self._format_header(field_names,
+                                            self.boxes,
+                                            self.time,
+                                            self.step_numbers))
 
     def writehdrnewboxes(self, pfdir, boxes, fields):
         """
         Write the global header with new boxes
         """
-        if pfdir not in os.listdir():
-            os.makedirs(os.getcwd(),pfdir)
-
+        os.makedirs(os.path.join(os.getcwd(), pfdir), exist_ok=True)
         with open(os.path.join(os.getcwd(),pfdir, 'Header'), 'w') as hfile:
-            # Plotfile version
-            hfile.write(self.version)
-            # Number of fields
-            hfile.write(f"{len(fields)}\n")
-            # Fields
-            for f in fields:
-                hfile.write(f + '\n')
-            # Dimension
-            hfile.write(f"{self.ndims}\n")
-            # Time is unknown
-            hfile.write("0.0\n")
-            # Max level
-            hfile.write(str(self.limit_level) + '\n')
-            # Lower bounds
-            lo_str = " ".join([f"{self.geo_low[i]}" for i in range(self.ndims)])
-            hfile.write(lo_str + '\n')
-            # Upper bounds
-            hi_str =  " ".join([f"{self.geo_high[i]}" for i in range(self.ndims)])
-            hfile.write(hi_str + '\n')
-            # Refinement factors
-            factors = self.factors[:self.limit_level]
-            hfile.write(' '.join([str(f) for f in factors]) + '\n')
-            # Grid sizes
-            # Looks like ((0,0,0) (7,7,7) (0,0,0))
-            tuples = []
-            for lv in range(self.limit_level + 1):
-                start = ','.join(['0' for _ in range(self.ndims)])
-                cente = ','.join([str(self.grid_sizes[lv][i] - 1) for i in range(self.ndims)])
-                end = start
-                tup = f"(({start}) ({cente}) ({end}))"
-                tuples.append(tup)
-            hfile.write(' '.join(tuples) + '\n')
-            # By level step numbers (all zero)
-            step_numbers = [0 for _ in range(self.limit_level + 1)]
-            hfile.write(' '.join([str(n) for n in step_numbers]) + '\n')
-            # Grid resolutions
-            for lv in range(self.limit_level + 1):
-                hfile.write(' '.join([f"{self.dx[lv][i]}" for i in range(self.ndims)]) + '\n')
-            # Coordinate system
-            hfile.write(str(self.sys_coord))
-            # Zero for parsing
-            hfile.write("0\n")
-            # Write the boxes
-            for lv in range(self.limit_level + 1):
-                # Write the level info
-                hfile.write(f"{lv} {len(boxes[lv])} 0.0\n")
-                # Write the level step
-                hfile.write(f"0\n")
-                # Write the 2D boxes
-                for box in boxes[lv]:
-                    for i in range(self.ndims):
-                        hfile.write(f"{box[i][0]} {box[i][1]}\n")
-                # Write the Level path info
-                hfile.write(f"Level_{lv}/Cell\n")
+            # Time and step numbers are unknown
+            hfile.write(self._format_header(fields,
+                                            boxes,
+                                            0.0,
+                                            [0 for _ in range(self.limit_level + 1)]))
+
+    def _format_header(self, fields, boxes, time, step_numbers):
+        """
+        Format the global header of a plotfile with the
+        structure of this plotfile up to self.limit_level
+        ___
+        fields: names of the fields in the plotfile
+        boxes: boxes bounds at each level
+        time: time of the plotfile
+        step_numbers: step number of each level
+        returns the header as a string
+        """
+        # Build the header in memory so it is written at once
+        parts = []
+        # Plotfile version
+        parts.append(self.version)
+        # Number of fields
+        parts.append(f"{len(fields)}\n")
+        # Fields
+        parts.append(''.join([f + '\n' for f in fields]))
+        # Number of dimensions
+        parts.append(f"{self.ndims}\n")
+        # Time
+        parts.append(str(time) + '\n')
+        # Max level
+        parts.append(str(self.limit_level) + '\n')
+        # Lower bounds
+        parts.append(' '.join(map(str, self.geo_low)) + '\n')
+        # Upper bounds
+        parts.append(' '.join(map(str, self.geo_high)) + '\n')
+        # Refinement factors (one between each level)
+        factors = self.factors[:self.limit_level]
+        parts.append(' '.join(map(str, factors)) + '\n')
+        # Grid sizes
+        # Looks like ((0,0,0) (7,7,7) (0,0,0))
+        sizes = [[int(n) - 1 for n in size]
+                 for size in self.grid_sizes[:self.limit_level + 1]]
+        zeros = ','.join(['0'] * self.ndims)
+        tuples = [f"(({zeros}) ({','.join(map(str, size))}) ({zeros}))"
+                  for size in sizes]
+        parts.append(' '.join(tuples) + '\n')
+        # By level step numbers
+        step_numbers = step_numbers[:self.limit_level + 1]
+        parts.append(' '.join(map(str, step_numbers)) + '\n')
+        # Grid resolutions
+        parts.append(''.join([' '.join(map(str, self.dx[lv])) + '\n'
+                              for lv in range(self.limit_level + 1)]))
+        # Coordinate system
+        parts.append(str(self.sys_coord))
+        # Zero for parsing
+        parts.append("0\n")
+        # Write the boxes
+        for lv in range(self.limit_level + 1):
+            # Write the level info
+            parts.append(f"{lv} {len(boxes[lv])} {time}\n")
+            # Write the level step
+            parts.append(f"{step_numbers[lv]}\n")
+            # Write the boxes, one (lo, hi) line per box dimension
+            lv_boxes = boxes[lv]
+            if hasattr(lv_boxes, 'tolist'):
+                # Format Python floats rather than array scalars
+                lv_boxes = lv_boxes.tolist()
+            parts.append(''.join([f"{lo} {hi}\n"
+                                  for box in lv_boxes
+                                  for lo, hi in box[:self.ndims]]))
+            # Write the Level path info
+            parts.append(f"Level_{lv}/Cell\n")
+        return ''.join(parts)
 
     def boxesfromindices(self, indexes):
         """
         Give a list if indexes with shape n_levels x [n_indexes_at_level]
         Compute the corresponding bounding boxes using the header data
+        returns a list with a (n_boxes, ndims, 2) array of the
+        (lo, hi) bounds of the boxes for each level
         """
         all_boxes = []
         for lv in range(self.limit_level + 1):
-            lv_boxes = []
-            xgrid = np.linspace(self.geo_low[0] + self.dx[lv][0]/2, 
-                                self.geo_high[0] - self.dx[lv][0]/2,
-                                self.grid_sizes[lv][0])
-            ygrid = np.linspace(self.geo_low[0] + self.dx[lv][0]/2, 
-                                self.geo_high[0] - self.dx[lv][0]/2,
-                                self.grid_sizes[lv][0])
-            zgrid = np.linspace(self.geo_low[0] + self.dx[lv][0]/2, 
-                                self.geo_high[0] - self.dx[lv][0]/2,
-                                self.grid_sizes[lv][0])
-            hdx = self.dx[lv][0]/2
-            hdy = self.dx[lv][1]/2
-            hdz = self.dx[lv][2]/2
-            for idx in indexes[lv]:
-                box_x = [xgrid[idx[0][0]] - hdx, xgrid[idx[1][0]] + hdx]
-                box_y = [ygrid[idx[0][1]] - hdy, ygrid[idx[1][1]] + hdy]
-                box_z = [zgrid[idx[0][2]] - hdz, zgrid[idx[1][2]] + hdz]
-                box = [box_x, box_y, box_z]
-                lv_boxes.append(box)
+            # (n_boxes, 2, ndims) array of the box indices
+            lv_indexes = np.asarray(indexes[lv], dtype=int).reshape(-1, 2, self.ndims)
+            lv_boxes = np.empty((len(lv_indexes), self.ndims, 2))
+            for coord in range(self.ndims):
+                # The grids are uniform so the box bounds are
+                # the faces of the low and high index cells
+                lo = self.geo_low[coord]
+                dx = self.dx[lv][coord]
+                lv_boxes[:, coord, 0] = lo + lv_indexes[:, 0, coord] * dx
+                lv_boxes[:, coord, 1] = lo + (lv_indexes[:, 1, coord] + 1) * dx
             all_boxes.append(lv_boxes)
         return all_boxes
@@ -1,8 +1,39 @@
 import os
+import functools
+import shutil
+import tempfile
 import unittest
+import multiprocessing
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from amr_kitchen import PlotfileCooker
+from amr_kitchen import plotfile_cooker
+from amr_kitchen.plotfile_cooker import FAB_HEADER_SCAN, LevelDataStream
+
+def read_bfile_boxes(nfields, bfname, offsets, indexes):
+    """
+    parallel_bybinfile worker reading every box of a binary file
+    """
+    data = []
+    shapes = indexes[:, 1, :] - indexes[:, 0, :] + 1
+    counts = shapes.prod(axis=1) * nfields
+    fd = os.open(bfname, os.O_RDONLY)
+    try:
+        for shape, count, ofs in zip(shapes.tolist(), counts.tolist(), offsets):
+            # Skip the FAB header line before the box data
+            header = os.pread(fd, FAB_HEADER_SCAN, ofs)
+            start = ofs + header.index(b'\n') + 1
+            buf = os.pread(fd, count * 8, start)
+            data.append(np.frombuffer(buf, 'float64').reshape((*shape, nfields),
+                                                              order='F'))
+    finally:
+        os.close(fd)
+    return data
+
+def read_level_data(hdr):
+    hdr[0][2][:]
 
 class TestSliceData(unittest.TestCase):
     pfile2d = "test_assets/example_plt_2d"
@@ -34,25 +65,248 @@ class TestSliceData(unittest.TestCase):
         self.assertTrue('mins' in hdr.cells[0])
         self.assertTrue('maxs' in hdr.cells[0])
 
-    def test_bybinfile_iterator2d(self):
-        hdr = PlotfileCooker(self.pfile2d)
+    def check_bybinfile_data(self, pfile):
+        hdr = PlotfileCooker(pfile)
+        worker = functools.partial(read_bfile_boxes, len(hdr.fields))
         for lv in range(hdr.limit_level + 1):
-            for bfname, offsets, indexes in hdr.bybinfile(lv):
-                with open(bfname) as bf:
-                    for idx, ofs in zip(indexes, offsets):
-                        shape = [idx[1][i] - idx[0][i] + 1 for i in range(hdr.ndims)]
-                        shape.append(len(hdr.fields))
-                        bf.seek(ofs)
-                        arr = np.fromfile(bf, 'float64', np.prod(shape))
-                        
+            bfile_data = hdr.parallel_bybinfile(lv, worker, max_workers=4)
+            self.assertEqual(sum([len(data) for data in bfile_data]),
+                             len(hdr.cells[lv]['offsets']))
+            # The workers output follows the binary file groups
+            for bf_indexes, data in zip(hdr.binfile_groups(lv).values(),
+                                        bfile_data):
+                for i, box_data in zip(bf_indexes, data):
+                    self.assertTrue(np.allclose(box_data, hdr[:][lv][int(i)]))
+
+    def test_bybinfile_iterator2d(self):
+        self.check_bybinfile_data(self.pfile2d)
+
     def test_bybinfile_iterator3d(self):
+        self.check_bybinfile_data(self.pfile3d)
+
+    def copy_plotfile(self, pfile):
+        """
+        Copy a plotfile without its cache files to a temporary
+        directory removed after the test
+        """
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "plt")
+        shutil.copytree(pfile, path, ignore=shutil.ignore_patterns("*.npz"))
+        return path
+
+    def test_header_cache(self):
+        pfile = self.copy_plotfile(self.pfile2d)
+        hdr = PlotfileCooker(pfile)
+        cache_path = os.path.join(pfile, ".pck_header_cache.npz")
+        self.assertTrue(os.path.isfile(cache_path))
+        # Second read uses the .pck_header_cache.npz file
+        PlotfileCooker._parse_cache.clear()
+        with mock.patch.object(PlotfileCooker, "parse_header",
+                               side_effect=AssertionError("header parsed")):
+            hdr_cached = PlotfileCooker(pfile, limit_level=0)
+        self.assertEqual(hdr.fields, hdr_cached.fields)
+        self.assertEqual(hdr.time, hdr_cached.time)
+        self.assertEqual(hdr.dx, hdr_cached.dx)
+        self.assertEqual(hdr.max_level, hdr_cached.max_level)
+        self.assertEqual(hdr_cached.limit_level, 0)
+        self.assertTrue(np.allclose(hdr.boxes[0], hdr_cached.boxes[0]))
+        self.assertEqual(len(hdr_cached.boxes), 1)
+        self.assertEqual(hdr.cell_paths[0], hdr_cached.cell_paths[0])
+
+    def test_damaged_header_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pfile = os.path.join(tmpdir, "plt")
+            shutil.copytree(self.pfile2d, pfile)
+            hdr = PlotfileCooker(pfile)
+            cache_path = os.path.join(pfile, ".pck_header_cache.npz")
+            with open(cache_path, "r+b") as cfile:
+                cfile.truncate(os.path.getsize(cache_path) // 2)
+            # The damaged cache is parsed again and replaced
+            PlotfileCooker._parse_cache.clear()
+            hdr_parsed = PlotfileCooker(pfile)
+            self.assertEqual(hdr.fields, hdr_parsed.fields)
+            for lv in range(hdr.limit_level + 1):
+                self.assertTrue(np.allclose(hdr.boxes[lv], hdr_parsed.boxes[lv]))
+            self.assertTrue(hdr_parsed.load_header_cache(
+                os.path.join(pfile, "Header"), None))
+
+    def test_parse_cache(self):
+        hdr = PlotfileCooker(self.pfile3d)
+        # Both reads use the header parsed for every level
+        hdr_lv0 = PlotfileCooker(self.pfile3d, limit_level=0)
+        hdr_lv1 = PlotfileCooker(self.pfile3d, limit_level=1)
+        self.assertIs(hdr_lv0._header_data, hdr._header_data)
+        self.assertIs(hdr_lv1._header_data, hdr._header_data)
+        self.assertEqual(len(hdr_lv0.boxes), 1)
+        self.assertEqual(len(hdr.boxes), hdr.max_level + 1)
+        self.assertEqual(len(hdr_lv1.cell_paths), 2)
+        self.assertTrue(np.allclose(hdr_lv1.boxes[1], hdr.boxes[1]))
+
+    def test_limited_header_read(self):
+        pfile = self.copy_plotfile(self.pfile3d)
+        # Only the boxes up to the limit level are read
+        hdr_lv0 = PlotfileCooker(pfile, limit_level=0)
+        self.assertEqual(hdr_lv0._header_data.nlevels, 1)
+        hdr = PlotfileCooker(pfile)
+        self.assertEqual(hdr._header_data.nlevels, hdr.max_level + 1)
+        self.assertEqual(len(hdr.boxes), hdr.max_level + 1)
+        self.assertTrue(np.allclose(hdr_lv0.boxes[0], hdr.boxes[0]))
+
+    def test_field_slice_read(self):
+        for pfile in [self.pfile2d, self.pfile3d]:
+            hdr = PlotfileCooker(pfile)
+            for lv in range(hdr.limit_level + 1):
+                slice_data = hdr[1:3][lv][:]
+                index_data = hdr[[1, 2]][lv][:]
+                self.assertEqual(np.shape(slice_data), np.shape(index_data))
+                self.assertTrue(np.allclose(slice_data, index_data))
+
+    def test_field_index_read(self):
+        for pfile in [self.pfile2d, self.pfile3d]:
+            hdr = PlotfileCooker(pfile)
+            nfields = len(hdr.fields)
+            # Sparse, unsorted dense and unsorted sparse indices
+            for fields in [[0, nfields - 1], [1, 0], [nfields - 1, 0]]:
+                for lv in range(hdr.limit_level + 1):
+                    index_data = hdr[fields][lv][:]
+                    field_data = np.stack([hdr[field][lv][:] for field in fields],
+                                          axis=-1)
+                    self.assertEqual(index_data.shape, field_data.shape)
+                    self.assertTrue(np.allclose(index_data, field_data))
+                    self.assertTrue(np.allclose(hdr[fields][lv][0], field_data[0]))
+
+    def test_field_slice_iter(self):
+        for pfile in [self.pfile2d, self.pfile3d]:
+            hdr = PlotfileCooker(pfile)
+            for lv in range(hdr.limit_level + 1):
+                for field_slice in [slice(1, 3), slice(0, 3, 2)]:
+                    read_data = hdr[field_slice][lv][:]
+                    # The iterator yields the boxes by binary file
+                    iter_data = list(hdr[field_slice][lv])
+                    self.assertEqual(len(iter_data), len(read_data))
+                    self.assertEqual(iter_data[0].shape, read_data[0].shape)
+                    self.assertTrue(np.allclose(
+                        np.sort([data.sum() for data in iter_data]),
+                        np.sort([data.sum() for data in read_data])))
+
+    def test_process_pool_read(self):
+        hdr = PlotfileCooker(self.pfile3d)
+        selector = hdr[[0, 2]]
+        selector.use_processes = True
+        for lv in range(hdr.limit_level + 1):
+            thread_data = hdr[[0, 2]][lv][:]
+            process_data = selector[lv][:]
+            self.assertTrue(np.allclose(thread_data, process_data))
+        del process_data
+        # The arenas are unlinked once their arrays are collected
+        self.assertTrue(all(arena.closed for arena in LevelDataStream._arenas))
+
+    def test_replaced_plotfile_read(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pfile = os.path.join(tmpdir, "plt")
+            shutil.copytree("test_assets/plt1_Y", pfile)
+            data_Y = PlotfileCooker(pfile)[0][0][0]
+            # Replace the plotfile at the same path
+            shutil.rmtree(pfile)
+            shutil.copytree("test_assets/plt2_F", pfile)
+            data_F = PlotfileCooker(pfile)[0][0][0]
+            expected = PlotfileCooker("test_assets/plt2_F")[0][0][0]
+            self.assertTrue(np.allclose(data_F, expected))
+            self.assertFalse(np.allclose(data_F, data_Y))
+
+    @unittest.skipIf(plotfile_cooker.resource is None, "requires resource")
+    def test_binary_file_cache_size(self):
+        # The macOS default open file limit
+        with mock.patch.object(plotfile_cooker.resource, "getrlimit",
+                               return_value=(256, 256)):
+            self.assertEqual(plotfile_cooker.binary_file_cache_size(), 128)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires fork")
+    def test_forked_read(self):
         hdr = PlotfileCooker(self.pfile3d)
+        hdr[0][2][:]
+        # The child must not use the thread pool of the parent
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=read_level_data, args=(hdr,))
+        proc.start()
+        proc.join(60)
+        if proc.is_alive():
+            proc.terminate()
+        self.assertEqual(proc.exitcode, 0)
+
+    def test_write_headers(self):
+        for pfile in [self.pfile2d, self.pfile3d]:
+            hdr = PlotfileCooker(pfile)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fields_path = os.path.join(tmpdir, "plt_fields")
+                os.makedirs(fields_path)
+                hdr.write_global_header_new_fields(fields_path, ["a", "b"])
+                boxes_path = os.path.join(tmpdir, "plt_boxes")
+                hdr.writehdrnewboxes(boxes_path, hdr.boxes, list(hdr.fields))
+                for path, fields in [(fields_path, ["a", "b"]),
+                                     (boxes_path, list(hdr.fields))]:
+                    hdr_new = PlotfileCooker(path, header_only=True)
+                    self.assertEqual(list(hdr_new.fields), fields)
+                    self.assertEqual(hdr_new.max_level, hdr.max_level)
+                    # One refinement ratio between each pair of levels
+                    # (as AMReX writes it, example_plt_2d has an extra one)
+                    self.assertEqual(hdr_new.factors, hdr.factors[:hdr.max_level])
+                    for lv in range(hdr.max_level + 1):
+                        self.assertTrue(np.array_equal(hdr_new.grid_sizes[lv],
+                                                       hdr.grid_sizes[lv]))
+                        self.assertTrue(np.allclose(hdr_new.boxes[lv], hdr.boxes[lv]))
+
+    def test_boxesfromindices(self):
+        hdr = PlotfileCooker(self.pfile3d)
+        boxes = hdr.boxesfromindices([hdr.cells[lv]['indexes']
+                                      for lv in range(hdr.limit_level + 1)])
+        for lv in range(hdr.limit_level + 1):
+            self.assertTrue(np.allclose(boxes[lv], hdr.boxes[lv]))
+
+    def test_damaged_cell_header_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pfile = os.path.join(tmpdir, "plt")
+            shutil.copytree(self.pfile3d, pfile)
+            hdr = PlotfileCooker(pfile, maxmins=True)
+            cache_path = os.path.join(pfile, hdr.cell_paths[0], "Cell_H.npz")
+            with open(cache_path, "r+b") as cfile:
+                cfile.truncate(os.path.getsize(cache_path) // 2)
+            # The damaged cache is parsed again and replaced
+            hdr_parsed = PlotfileCooker(pfile, maxmins=True)
+            self.assertTrue(np.array_equal(hdr.cells[0]['offsets'],
+                                           hdr_parsed.cells[0]['offsets']))
+            self.assertIsNotNone(hdr_parsed.load_cell_header_cache(
+                os.path.join(pfile, hdr.cell_paths[0], "Cell_H"), True))
+
+    def test_concurrent_cell_header_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pfile = os.path.join(tmpdir, "plt")
+            shutil.copytree(self.pfile3d, pfile)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(PlotfileCooker, pfile, maxmins=True)
+                           for _ in range(8)]
+                hdrs = [future.result() for future in futures]
+            for hdr in hdrs:
+                self.assertTrue(np.array_equal(hdr.cells[0]['offsets'],
+                                               hdrs[0].cells[0]['offsets']))
+            # No temporary file is left next to the caches
+            self.assertEqual([name for name in os.listdir(os.path.join(pfile, "Level_0"))
+                              if name.endswith(".tmp")], [])
+
+    def test_cell_header_cache(self):
+        pfile = self.copy_plotfile(self.pfile3d)
+        hdr = PlotfileCooker(pfile, maxmins=True)
+        # Second read uses the Cell_H.npz files
+        hdr_cached = PlotfileCooker(pfile, maxmins=True)
         for lv in range(hdr.limit_level + 1):
-            for bfname, offsets, indexes in hdr.bybinfile(lv):
-                with open(bfname) as bf:
-                    for idx, ofs in zip(indexes, offsets):
-                        shape = [idx[1][i] - idx[0][i] + 1 for i in range(hdr.ndims)]
-                        shape.append(len(hdr.fields))
-                        bf.seek(ofs)
-                        arr = np.fromfile(bf, 'float64', np.prod(shape))
-                    
+            cache_path = os.path.join(pfile, hdr.cell_paths[lv], "Cell_H.npz")
+            self.assertTrue(os.path.isfile(cache_path))
+            self.assertTrue(np.array_equal(hdr.cells[lv]['files'],
+                                           hdr_cached.cells[lv]['files']))
+            self.assertTrue(np.array_equal(hdr.cells[lv]['offsets'],
+                                           hdr_cached.cells[lv]['offsets']))
+            self.assertTrue(np.allclose(hdr.cells[lv]['indexes'],
+                                        hdr_cached.cells[lv]['indexes']))
+            self.assertTrue(np.allclose(hdr.cells[lv]['maxs']['temp'],
+                                        hdr_cached.cells[lv]['maxs']['temp']))